@@ -1,13 +1,181 @@
+import collections
+import functools
 import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import xarray as xr
 import s3fs
 import pandas as pd
 
+try:
+    import orjson
+except ImportError:  # orjson ships in package.zip, fall back to the standard library encoder without it
+    orjson = None
+
+try:
+    from snapshot_restore_py import register_after_restore
+except ImportError:  # only provided by the Lambda runtime
+    register_after_restore = None
+
 # DEFAULT_REST_ENDPOINT = 'https://geoglows.ecmwf.int/api/'
 # DEFAULT_REST_ENDPOINT_VERSION = 'v2'  # 'v1, v2, latest'
 ODP_CORE_S3_BUCKET_URI = 's3://geoglows-v2-retrospective'
 ODP_RETROSPECTIVE_S3_BUCKET_URI = 's3://geoglows-v2-retrospective'
 ODP_S3_BUCKET_REGION = 'us-west-2'
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 2 ** 20))
+
+# opened once per container and reused by warm invocations
+_FS = None
+_RETRO_DS = None
+_RP_DS = None
+_QOUT = None
+# group keys of the time index, keyed on (kind, first time, length) since the time axis is append-only
+_GROUP_KEY_CACHE = {}
+# retrospective responses keyed on (reach_id, start_date, end_date, format), least recently used first
+_RESPONSE_CACHE = collections.OrderedDict()
+_RESPONSE_CACHE_BYTES = 0
+
+def _s3() -> s3fs.S3FileSystem:
+    """
+    Returns the shared anonymous S3 filesystem, creating it on first use.
+    """
+    global _FS
+    if _FS is None:
+        # zarr requests all chunks of a selection at once, allow enough connections to fetch them concurrently
+        _FS = s3fs.S3FileSystem(anon=True,
+                                client_kwargs=dict(region_name=ODP_S3_BUCKET_REGION),
+                                config_kwargs=dict(max_pool_connections=64))
+    return _FS
+
+def _retrospective_dataset() -> xr.Dataset:
+    """
+    Returns the retrospective zarr dataset, opening it on first use.
+    """
+    global _RETRO_DS
+    if _RETRO_DS is None:
+        s3store = s3fs.S3Map(root=f'{ODP_RETROSPECTIVE_S3_BUCKET_URI}/retrospective.zarr', s3=_s3(), check=False)
+        _RETRO_DS = xr.open_zarr(s3store, consolidated=True, chunks=None)
+    return _RETRO_DS
+
+def _retrospective_qout() -> xr.DataArray:
+    """
+    Returns the Qout variable of the retrospective dataset, bound once so requests select from the same array.
+    """
+    global _QOUT
+    if _QOUT is None:
+        _QOUT = _retrospective_dataset()['Qout']
+    return _QOUT
+
+def _returnperiods_dataset() -> xr.Dataset:
+    """
+    Returns the return periods zarr dataset, opening it on first use.
+    """
+    global _RP_DS
+    if _RP_DS is None:
+        s3store = s3fs.S3Map(root=f'{ODP_RETROSPECTIVE_S3_BUCKET_URI}/return-periods.zarr', s3=_s3(), check=False)
+        _RP_DS = xr.open_zarr(s3store, consolidated=True, chunks=None)
+    return _RP_DS
+
+def _open_stores() -> None:
+    """
+    Opens the retrospective and return periods stores concurrently so both are ready before the first request.
+    """
+    _s3()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(_retrospective_qout), executor.submit(_returnperiods_dataset)]
+    for future in futures:
+        future.result()
+
+def _json_default(obj) -> object:
+    """
+    Converts numpy arrays and scalars the JSON encoder cannot write natively.
+
+    Only the standard library fallback sends whole arrays here, orjson serializes them itself.
+    """
+    if isinstance(obj, np.ndarray) and obj.dtype.kind == 'M':
+        return np.datetime_as_string(obj, unit='s').tolist()
+    if isinstance(obj, np.ndarray) and obj.dtype.kind == 'f':
+        # missing values are written as null, NaN is not valid JSON
+        return np.where(np.isfinite(obj), obj.astype(np.float64), None).tolist()
+    return obj.tolist()
+
+def _dumps(obj) -> str:
+    """
+    Serializes an object to a JSON string, using orjson when it is available.
+
+    Args:
+        obj: The object to serialize.
+
+    Returns:
+        str: The JSON encoded object.
+    """
+    if orjson is None:
+        return json.dumps(obj, default=_json_default, allow_nan=False, separators=(',', ':'))
+    return orjson.dumps(obj, default=_json_default,
+                        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+def _to_csv(df: pd.DataFrame) -> str:
+    """
+    Writes a DataFrame to CSV without its index, with floats to three decimals.
+
+    Numeric columns are formatted one column at a time with str.format and joined into rows, which is much faster
+    than DataFrame.to_csv and produces the same text. Other frames fall back to DataFrame.to_csv.
+
+    Args:
+        df (pd.DataFrame): The data to write.
+
+    Returns:
+        str: The CSV text.
+    """
+    if (df.columns.nlevels > 1 or df.shape[1] == 0
+            or any(dtype.kind not in 'fiu' for dtype in df.dtypes)
+            or any(isinstance(column, str) and any(c in column for c in ',"\r\n') for column in df.columns)):
+        return df.to_csv(index=False, float_format='%.3f')
+    # pandas writes a missing value as an empty field, quoted when it is the only field in the row
+    missing = '""' if df.shape[1] == 1 else ''
+    columns = []
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype.kind == 'f':
+            formatted = list(map('{:.3f}'.format, values.tolist()))
+            for i in np.flatnonzero(np.isnan(values)):
+                formatted[i] = missing
+        else:
+            formatted = list(map(str, values.tolist()))
+        columns.append(formatted)
+    rows = columns[0] if len(columns) == 1 else map(','.join, zip(*columns))
+    return '\n'.join([','.join(map(str, df.columns)), *rows]) + '\n'
+
+def _response(df: pd.DataFrame, params: dict[str]) -> dict[str]:
+    """
+    Builds the response for a DataFrame in the format requested by the query parameters.
+
+    Args:
+        df (pd.DataFrame): The data to return.
+        params (dict[str]): The query parameters, 'format' may be 'csv' (default) or 'json'.
+
+    Returns:
+        dict[str]: The response containing the status code, content type header and the serialized data.
+    """
+    fmt = params.get('format', False) or 'csv'
+    if fmt == 'csv':
+        output = _to_csv(df)
+        content_type = 'text/csv'
+    elif fmt == 'json':
+        # the same layout as DataFrame.to_json(orient='split'), with the arrays written by the encoder
+        if df.dtypes.nunique() <= 1:
+            data = df.to_numpy()
+        else:
+            # to_numpy would upcast mixed columns to one dtype, convert each column on its own to keep ints as ints
+            data = [list(row) for row in zip(*(_json_default(df[column].to_numpy()) for column in df.columns))]
+        output = _dumps({'columns': df.columns.to_numpy(), 'index': df.index.to_numpy(), 'data': data})
+        content_type = 'application/json'
+    else:
+        raise ValueError(f"Unsupported format {fmt}")
+
+    return {'statusCode': 200, 'headers': {'Content-Type': content_type}, 'body': output}
 
 def _retrospective(reach_id: int, params: dict[str] = {}) -> pd.DataFrame:
     """
@@ -20,56 +188,208 @@ def _retrospective(reach_id: int, params: dict[str] = {}) -> pd.DataFrame:
     Returns:
         pd.DataFrame: A pandas DataFrame containing the retrospective data.
     """
-    s3 = s3fs.S3FileSystem(anon=True, client_kwargs=dict(region_name=ODP_S3_BUCKET_REGION))
-    s3store = s3fs.S3Map(root=f'{ODP_RETROSPECTIVE_S3_BUCKET_URI}/retrospective.zarr', s3=s3, check=False)
-    df = (xr.open_zarr(s3store, consolidated=True, )
-                       .sel(rivid=reach_id)
-                       .to_pandas()
-                       .reset_index()
-                       .set_index('time')
-                       .pivot(columns='rivid', values='Qout')
-            )
-    if params.get('end_date', False):
-        df = df[df.index <= pd.to_datetime(params['end_date'])]
-    if params.get('start_date', False):
-        df = df[df.index >= pd.to_datetime(params['start_date'])]
-    return df
+    start = pd.to_datetime(params['start_date']) if params.get('start_date', False) else None
+    end = pd.to_datetime(params['end_date']) if params.get('end_date', False) else None
+    qout = _retrospective_qout()
+    if np.isscalar(reach_id):
+        # a single reach, resolve positions directly and skip building a labelled DataArray
+        time_index = qout.indexes['time']
+        times = time_index.slice_indexer(start, end)
+        values = qout.variable.isel(rivid=qout.indexes['rivid'].get_loc(reach_id), time=times).values
+        return pd.DataFrame({reach_id: values}, index=time_index[times])
+    da = qout.sel(rivid=reach_id, time=slice(start, end))
+    return da.transpose('time', 'rivid').to_pandas()
 
-def retrospective(path: list[str], event: dict[str]) -> dict:
+@functools.lru_cache(maxsize=1024)
+def _returnperiods(reach_id: int) -> pd.DataFrame:
     """
-    Retrieves retrospective data for a specified reach ID.
+    Retrieves the return periods for a specific reach ID, remembering recently requested reaches.
+
+    Parameters:
+        reach_id (int): The ID of the reach.
+
+    Returns:
+        pd.DataFrame: A pandas DataFrame containing the return periods, shared between calls so it must not be modified.
+    """
+    return _returnperiods_dataset().sel(rivid=reach_id).to_dataframe()
+
+def _retrospective_response(reach_id: int, start_date: str, end_date: str, fmt: str) -> dict[str]:
+    """
+    Builds the retrospective response for a reach ID, remembering the most recently used responses.
+
+    The cache is bounded by the total size of the cached bodies, set in bytes by the RESPONSE_CACHE_MAX_BYTES
+    environment variable (default 32 MiB, 0 turns the cache off). It lives as long as the container, so
+    redeploying the function is the only way to invalidate it, e.g. after a new retrospective release.
+
+    Parameters:
+        reach_id (int): The ID of the reach.
+        start_date (str): The first date to include, or None to start at the beginning of the simulation.
+        end_date (str): The last date to include, or None to end at the end of the simulation.
+        fmt (str): The response format, 'csv' or 'json', or None for csv.
+
+    Returns:
+        dict[str]: The response, shared between calls so it must not be modified.
+    """
+    global _RESPONSE_CACHE_BYTES
+    key = (reach_id, start_date, end_date, fmt)
+    if key in _RESPONSE_CACHE:
+        _RESPONSE_CACHE.move_to_end(key)
+        return _RESPONSE_CACHE[key]
+
+    params = {'start_date': start_date, 'end_date': end_date, 'format': fmt}
+    df = _retrospective(reach_id, params)
+    if fmt == 'json':
+        # float32 keeps the significant digits of discharge and shortens every number the encoder writes, CSV
+        # is formatted from the full values so its three decimals are exact
+        df = df.astype(np.float32, copy=False)
+    response = _response(df, params)
+    # the bodies are ASCII so their length is their size in bytes
+    size = len(response['body'])
+    if 0 < RESPONSE_CACHE_MAX_BYTES and size <= RESPONSE_CACHE_MAX_BYTES:
+        _RESPONSE_CACHE[key] = response
+        _RESPONSE_CACHE_BYTES += size
+        while _RESPONSE_CACHE_BYTES > RESPONSE_CACHE_MAX_BYTES:
+            _, evicted = _RESPONSE_CACHE.popitem(last=False)
+            _RESPONSE_CACHE_BYTES -= len(evicted['body'])
+    return response
+
+def _group_keys(index: pd.DatetimeIndex) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the day of the year groups (month * 100 + day) of a time index, computing them once per warm container.
+    Monthly groups are built by _month_segments.
+
+    Args:
+        index (pd.DatetimeIndex): The time index to group.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The sorted unique group keys and the position of each time in them.
+    """
+    cache_key = ('daily', index[0] if len(index) else None, len(index))
+    if cache_key not in _GROUP_KEY_CACHE:
+        keys = index.month.values * 100 + index.day.values
+        _GROUP_KEY_CACHE[cache_key] = np.unique(keys, return_inverse=True)
+    return _GROUP_KEY_CACHE[cache_key]
+
+def _month_segments(index: pd.DatetimeIndex) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Splits a sorted time index into runs of consecutive times in the same year and month, computing them once
+    per warm container.
+
+    Args:
+        index (pd.DatetimeIndex): The monotonic time index to split.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The sorted unique months, the position of each run's month in
+                                                   them, and the position in the index where each run starts.
+    """
+    cache_key = ('month_segments', index[0] if len(index) else None, len(index))
+    if cache_key not in _GROUP_KEY_CACHE:
+        if len(index):
+            month_starts = np.arange(index[0].to_datetime64().astype('datetime64[M]'),
+                                     index[-1].to_datetime64().astype('datetime64[M]') + 1)
+        else:
+            month_starts = np.array([], dtype='datetime64[M]')
+        starts = np.searchsorted(index.values, month_starts.astype(index.values.dtype))
+        # drop months without any times, their start is the same as the next month's
+        nonempty = np.append(starts[1:] != starts[:-1], starts[-1:] < len(index))
+        months = month_starts[nonempty].astype(np.int64) % 12 + 1
+        groups, inverse = np.unique(months, return_inverse=True)
+        _GROUP_KEY_CACHE[cache_key] = groups, inverse, starts[nonempty]
+    return _GROUP_KEY_CACHE[cache_key]
+
+def _group_mean(df: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """
+    Averages the rows of a DataFrame that fall in the same calendar group, skipping missing values.
+
+    Args:
+        df (pd.DataFrame): The data to average, indexed by time.
+        freq (str): 'daily' to average per day of the year, 'monthly' to average per month.
+
+    Returns:
+        pd.DataFrame: The mean of each column per group, indexed by zero padded '%m%d' or '%m' labels.
+    """
+    values = df.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    if freq == 'monthly':
+        # each month of each year is a contiguous run of the sorted index, sum the runs first so only
+        # one row per year and month is left to group
+        groups, inverse, starts = _month_segments(df.index)
+        values = np.add.reduceat(values, starts, axis=0)
+        valid = np.add.reduceat(valid.astype(np.float64), starts, axis=0)
+    else:
+        groups, inverse = _group_keys(df.index)
+    # one bin per (group, column) pair so every column is reduced in a single bincount pass
+    n_groups, n_columns = len(groups), values.shape[1]
+    bins = (inverse[:, np.newaxis] * n_columns + np.arange(n_columns)).ravel()
+    sums = np.bincount(bins, weights=values.ravel(), minlength=n_groups * n_columns)
+    counts = np.bincount(bins, weights=valid.ravel(), minlength=n_groups * n_columns)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums / counts).reshape(n_groups, n_columns)
+    label = '{:04d}'.format if freq == 'daily' else '{:02d}'.format
+    return pd.DataFrame(means, index=[label(group) for group in groups.tolist()], columns=df.columns)
+
+def _warm_up() -> None:
+    """
+    Opens the zarr stores and builds the caches requests reuse, so the work happens during container init
+    and is captured in a SnapStart snapshot.
+    """
+    _open_stores()
+    time_index = _retrospective_qout().indexes['time']
+    _group_keys(time_index)
+    _month_segments(time_index)
+    # run the response writers once so the modules they import lazily are loaded
+    sample = pd.DataFrame({0: np.zeros(1, dtype=np.float32)})
+    _response(sample, {'format': 'csv'})
+    _response(sample, {'format': 'json'})
+    sample.to_csv(index=False)
+
+def _after_restore() -> None:
+    """
+    Replaces the S3 connections restored from a SnapStart snapshot, which are no longer open.
+    """
+    if _FS is not None:
+        _FS.connect(refresh=True)
+
+def _parse(path: list[str], event: dict[str]) -> tuple[int, dict[str]] | dict[str]:
+    """
+    Parses the reach ID from the request path and the query string parameters from the event.
 
     Args:
         path (list[str]): The path of the request URL.
         event (dict[str]): The event object containing the request parameters.
 
     Returns:
-        dict: The response containing the status code and the data in the specified format.
+        tuple[int, dict[str]] | dict[str]: The reach ID and query parameters, or the error response if the path
+                                           does not contain a valid reach ID.
     """
     if not len(path) > 2:
         return {'statesCode': 422,
                 'body': f"Bad request: No reachID specified"}
     try:
-        params = {}
-        if event.get("queryStringParameters", False):
-            params = event["queryStringParameters"]
         reach_id = int(path[2])
     except ValueError:
         return {'statesCode': 400,
                 'body': f"Bad request: couldn't make {path[2]} into an integer"}
-    
-    df = _retrospective(reach_id, params)
-    if params.get('format', False):
-        if params['format'] == 'csv':
-            output = df.to_csv(index=False)
-        elif params['format'] == 'json':
-            output = df.to_json(index=False)
-        else:
-            raise ValueError()
-    else:
-        output = df.to_csv(index=False)
+    return reach_id, event.get("queryStringParameters") or {}
+
+def retrospective(path: list[str], event: dict[str]) -> dict:
+    """
+    Retrieves retrospective data for a specified reach ID.
+
+    Args:
+        path (list[str]): The path of the request URL.
+        event (dict[str]): The event object containing the request parameters.
+
+    Returns:
+        dict: The response containing the status code and the data in the specified format.
+    """
+    parsed = _parse(path, event)
+    if isinstance(parsed, dict):
+        return parsed
+    reach_id, params = parsed
 
-    return {'statusCode': 200, 'body': json.dumps(output)}
+    return _retrospective_response(reach_id, params.get('start_date'), params.get('end_date'), params.get('format'))
 
 def check_if_valid_request(event: dict) -> str or dict[str]: # type: ignore
     """
@@ -105,32 +425,14 @@ def daily_averages(path: list[str], event: dict[str]) -> dict[str]:
     Returns:
         dict[str]: The response containing the status code and the calculated averages.
     """
+    parsed = _parse(path, event)
+    if isinstance(parsed, dict):
+        return parsed
+    reach_id, params = parsed
 
-    if not len(path) > 2:
-        return {'statesCode': 422,
-                'body': f"Bad request: No reachID specified"}
-    try:
-        params = {}
-        if event["requestContext"].get("queryStringParameters", False):
-            params = event["requestContext"]["queryStringParameters"]
-        reach_id = int(path[2])
-    except ValueError:
-        return {'statesCode': 400,
-                'body': f"Bad request: couldn't make {path[2]} into an integer"}
-    
     df = _retrospective(reach_id, {})
-    df = df.groupby(df.index.strftime('%m%d')).mean()
-    if params.get('format', False):
-        if params['format'] == 'csv':
-            output = df.to_csv(index=False)
-        elif params['format'] == 'json':
-            output = df.to_json(index=False)
-        else:
-            raise ValueError()
-    else:
-        output = df.to_csv(index=False)
-
-    return {'statusCode': 200, 'body': json.dumps(output)}
+    df = _group_mean(df, 'daily')
+    return _response(df, params)
 
 def monthly_averages(path: list[str], event: dict[str]) -> dict[str]:
     """
@@ -143,32 +445,14 @@ def monthly_averages(path: list[str], event: dict[str]) -> dict[str]:
     Returns:
         dict[str]: The response containing the status code and body.
     """
+    parsed = _parse(path, event)
+    if isinstance(parsed, dict):
+        return parsed
+    reach_id, params = parsed
 
-    if not len(path) > 2:
-        return {'statesCode': 422,
-                'body': f"Bad request: No reachID specified"}
-    try:
-        params = {}
-        if event["requestContext"].get("queryStringParameters", False):
-            params = event["requestContext"]["queryStringParameters"]
-        reach_id = int(path[2])
-    except ValueError:
-        return {'statesCode': 400,
-                'body': f"Bad request: couldn't make {path[2]} into an integer"}
-    
     df = _retrospective(reach_id, {})
-    df = df.groupby(df.index.strftime('%m')).mean()
-    if params.get('format', False):
-        if params['format'] == 'csv':
-            output = df.to_csv(index=False)
-        elif params['format'] == 'json':
-            output = df.to_json(index=False)
-        else:
-            raise ValueError()
-    else:
-        output = df.to_csv(index=False)
-
-    return {'statusCode': 200, 'body': json.dumps(output)}
+    df = _group_mean(df, 'monthly')
+    return _response(df, params)
 
 def returnperiods(path: list[str], event: dict[str]) -> dict[str]:
     """
@@ -181,33 +465,13 @@ def returnperiods(path: list[str], event: dict[str]) -> dict[str]:
     Returns:
         dict[str]: The response containing the status code and the data in the specified format.
     """
+    parsed = _parse(path, event)
+    if isinstance(parsed, dict):
+        return parsed
+    reach_id, params = parsed
 
-    if not len(path) > 2:
-        return {'statesCode': 422,
-                'body': f"Bad request: No reachID specified"}
-    try:
-        params = {}
-        if event["requestContext"].get("queryStringParameters", False):
-            params = event["requestContext"]["queryStringParameters"]
-        reach_id = int(path[2])
-    except ValueError:
-        return {'statesCode': 400,
-                'body': f"Bad request: couldn't make {path[2]} into an integer"}
-    
-    s3 = s3fs.S3FileSystem(anon=True, client_kwargs=dict(region_name=ODP_S3_BUCKET_REGION))
-    s3store = s3fs.S3Map(root=f'{ODP_RETROSPECTIVE_S3_BUCKET_URI}/return-periods.zarr', s3=s3, check=False)
-    df = xr.open_zarr(s3store).sel(rivid=reach_id).to_dataframe()
-    if params.get('format', False):
-        if params['format'] == 'csv':
-            output = df.to_csv(index=False)
-        elif params['format'] == 'json':
-            output = df.to_json(index=False)
-        else:
-            raise ValueError()
-    else:
-        output = df.to_csv(index=False)
-
-    return {'statusCode': 200, 'body': json.dumps(output)}
+    df = _returnperiods(reach_id)
+    return _response(df, params)
 
 def lambda_handler(event, context):
     """
@@ -242,3 +506,12 @@ def lambda_handler(event, context):
         'statusCode': 200,
         'body': json.dumps(event)
     }
+
+try:
+    _warm_up()
+except Exception:
+    # the lazy getters retry on the first request, where the error is reported to the caller
+    logging.exception("warm-up failed")
+
+if register_after_restore is not None:
+    register_after_restore(_after_restore)